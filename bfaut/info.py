@@ -1,68 +1,180 @@
 #!/usr/bin/env python
 
+import asyncio
+import json
 from pprint import pprint
 import signal
 import sqlite3
-import pandas as pd
+import types
 from pubnub.callbacks import SubscribeCallback
 from pubnub.pnconfiguration import PNConfiguration, PNReconnectionPolicy
-from pubnub.pubnub_tornado import PubNubTornado
+from pubnub import pubnub_tornado
 import pybitflyer
 from tornado import gen
+from tornado.ioloop import PeriodicCallback
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 
 class BfAsyncSubscriber:
+    __slots__ = ('channels', 'pubnub')
+
     def __init__(self, channels):
         self.channels = channels
         pnc = PNConfiguration()
         pnc.subscribe_key = 'sub-c-52a9ab50-291b-11e5-baaa-0619f8945a4f'
         pnc.reconnect_policy = PNReconnectionPolicy.LINEAR
-        self.pubnub = PubNubTornado(pnc)
+        self.pubnub = pubnub_tornado.PubNubTornado(pnc)
 
     @gen.coroutine
     def subscribe(self):
         return self.pubnub.subscribe().channels(self.channels).execute()
 
+    def start(self):
+        for s in [signal.SIGINT, signal.SIGTERM]:
+            signal.signal(s, self._stop_from_signal)
+        self.pubnub.start()
+
+    def _stop_from_signal(self, signum, frame):
+        self.pubnub.ioloop.add_callback_from_signal(self.pubnub.stop)
+
 
 class BfSubscribeCallback(SubscribeCallback):
-    def __init__(self, sqlite_path=None, quiet=False):
-        self.db = sqlite3.connect(sqlite_path) if sqlite_path else None
+    __slots__ = (
+        'db', 'handlers', 'quiet', 'buffer_size', 'columns', 'inserts',
+        'buffers'
+    )
+
+    def __init__(self, channels, sqlite_path=None, quiet=False,
+                 buffer_size=200):
+        if sqlite_path:
+            self.db = sqlite3.connect(sqlite_path)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.handlers = {
+                c: (
+                    self._buffer_ticker if c.startswith('lightning_ticker_')
+                    else self._buffer_executions
+                ) for c in channels if c.startswith((
+                    'lightning_ticker_', 'lightning_executions_'
+                ))
+            }
+        else:
+            self.db = None
+            self.handlers = {}
         self.quiet = quiet
+        self.buffer_size = buffer_size
+        self.columns = {}                                       # mutable
+        self.inserts = {}                                       # mutable
+        self.buffers = {}                                       # mutable
 
     def message(self, pubnub, message):
-        if self.db:
-            if message.channel.startswith('lightning_ticker_'):
-                pd.DataFrame(
-                    [message.message]
-                ).assign(
-                    timestamp=lambda d: pd.to_datetime(d['timestamp'])
-                ).set_index(
-                    'timestamp'
-                ).to_sql(
-                    name=message.channel, con=self.db, if_exists='append'
-                )
-            elif message.channel.startswith('lightning_executions_'):
-                pd.DataFrame(
-                    message.message
-                ).assign(
-                    exec_date=lambda d: pd.to_datetime(d['exec_date'])
-                ).set_index(
-                    'exec_date'
-                ).to_sql(
-                    name=message.channel, con=self.db, if_exists='append'
-                )
+        if message.channel in self.handlers:
+            self.handlers[message.channel](
+                channel=message.channel, message=message.message
+            )
         if not self.quiet:
             print({message.channel: message.message})
 
+    def _buffer_ticker(self, channel, message):
+        self._buffer_rows(table=channel, records=[message], index='timestamp')
+
+    def _buffer_executions(self, channel, message):
+        self._buffer_rows(table=channel, records=message, index='exec_date')
+
+    def _buffer_rows(self, table, records, index):
+        if records:
+            if table not in self.columns:
+                self._create_table(table=table, record=records[0], index=index)
+            columns = self.columns[table][1:]
+            buffer = self.buffers.setdefault(table, [])
+            buffer.extend([
+                tuple(
+                    [self._format_datetime(r[index])] +
+                    [r.get(c) for c in columns]
+                ) for r in records
+            ])
+            if len(buffer) >= self.buffer_size:
+                self.flush(tables=[table])
+
+    def _create_table(self, table, record, index):
+        columns = [index] + [k for k in record.keys() if k != index]
+        column_types = ['TIMESTAMP'] + [
+            (
+                'INTEGER' if isinstance(record[c], int) else (
+                    'REAL' if isinstance(record[c], float) else 'TEXT'
+                )
+            ) for c in columns[1:]
+        ]
+        with self.db:
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS "{0}" ({1})'.format(
+                    table, ', '.join([
+                        '"{0}" {1}'.format(*ct)
+                        for ct in zip(columns, column_types)
+                    ])
+                )
+            )
+            self.db.execute(
+                'CREATE INDEX IF NOT EXISTS "ix_{0}_{1}" ON "{0}" ("{1}")'
+                .format(table, index)
+            )
+        self.columns[table] = columns
+        self.inserts[table] = 'INSERT INTO "{0}" ({1}) VALUES ({2})'.format(
+            table, ', '.join(['"{}"'.format(c) for c in columns]),
+            ', '.join(['?'] * len(columns))
+        )
+
+    @staticmethod
+    def _format_datetime(iso):
+        dt, _, fraction = iso.rstrip('Z').partition('.')
+        return '{0}{1}{2}'.format(
+            dt.replace('T', ' '),
+            ('.{:0<6}'.format(fraction[:6]) if fraction else ''),
+            ('+00:00' if iso.endswith('Z') else '')
+        )
+
+    def flush(self, tables=None):
+        for t in (tables or list(self.buffers.keys())):
+            rows = self.buffers.pop(t, None)
+            if rows:
+                with self.db:
+                    self.db.executemany(self.inserts[t], rows)
+
+
+def use_uvloop():
+    if uvloop:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+
+def use_orjson():
+    if orjson:
+        pubnub_tornado.json = types.SimpleNamespace(
+            **dict(vars(json), loads=orjson.loads)
+        )
+
 
 def stream_rate(channels, sqlite_path=None, quiet=False):
+    use_uvloop()
+    use_orjson()
     bas = BfAsyncSubscriber(channels=channels)
-    bas.pubnub.add_listener(
-        BfSubscribeCallback(sqlite_path=sqlite_path, quiet=quiet)
+    bsc = BfSubscribeCallback(
+        channels=channels, sqlite_path=sqlite_path, quiet=quiet
     )
+    bas.pubnub.add_listener(bsc)
     bas.subscribe()
-    signal.signal(signal.SIGINT, signal.SIG_DFL)
-    bas.pubnub.start()
+    if bsc.db:
+        PeriodicCallback(bsc.flush, 1000).start()
+    bas.start()
+    if bsc.db:
+        bsc.flush()
+        bsc.db.close()
 
 
 def print_states(config, pair, items):
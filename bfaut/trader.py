@@ -1,18 +1,31 @@
 #!/usr/bin/env python
 
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 import logging
+import math
 from pprint import pprint
-import signal
+import time
 import numpy as np
-import pandas as pd
 from pubnub.callbacks import SubscribeCallback
 import pybitflyer
-from .info import BfAsyncSubscriber
+from .info import BfAsyncSubscriber, use_orjson, use_uvloop
 from .util import BfautError
 
 
 class BfStreamTrader(SubscribeCallback):
+    __slots__ = (
+        'logger', 'bF', 'trade', 'pair', 'fx_pair', 'display_pair',
+        'timeout_sec', 'quiet', 'sfd_pins', 'betting_system', 'contrary',
+        'flash', 'retry', 'ewm_alpha', 'bollinger', 'bollinger_sigmas',
+        'unit_size', 'init_size', 'min_size', 'max_size', 'api_ttl',
+        'executor', 'getcollateral', 'getpositions', 'sendchildorder', 'ticks',
+        'open', 'won', 'n_load', 'ewm_dv', 'bollinger_band', 'order_side',
+        'init_margin', 'margin', 'position', 'sfd_penal_side', 'volumes',
+        'reserved', 'order_time', 'last_open', 'retried_side',
+        'anchor_margin', 'n_size_over', 'api_cache'
+    )
+    reversed_sides = {'BUY': 'SELL', 'SELL': 'BUY'}
+
     def __init__(self, config, pair, timeout, quiet=False):
         self.logger = logging.getLogger(__name__)
         self.bF = pybitflyer.API(
@@ -21,52 +34,77 @@ class BfStreamTrader(SubscribeCallback):
         )
         self.trade = config['trade']
         self.pair = pair
-        self.timeout_delta = timedelta(seconds=int(timeout))
+        self.fx_pair = 'FX_' + pair
+        self.display_pair = pair.replace('_', '-FX/')
+        self.timeout_sec = float(timeout)
         self.quiet = quiet
         self.sfd_pins = np.array([0.05, 0.1, 0.15, 0.2])
         self.betting_system = self.trade.get('bet')
         self.contrary = self.trade.get('contrary')
         self.flash = self.trade.get('flash')
         self.retry = self.trade.get('retry')
+        self.ewm_alpha = self.trade['ewm_alpha']
+        self.bollinger = self.trade.get('bollinger')
+        self.bollinger_sigmas = tuple(sorted(
+            float(s) for m in (
+                self.bollinger
+                if self.bollinger and isinstance(self.bollinger, list)
+                else [self.bollinger or 0]
+            ) for s in [- m, m]
+        ))
+        self.unit_size = self.trade['size'].get('unit')
+        self.init_size = (
+            self.trade['size'].get('init') or self.unit_size or 0.001
+        )
+        self.min_size = self.trade['size'].get('min')
+        self.max_size = self.trade['size'].get('max')
+        self.api_ttl = self.trade.get('api_ttl', 0.2)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.getcollateral = self.bF.getcollateral
+        self.getpositions = self.bF.getpositions
+        self.sendchildorder = self.bF.sendchildorder
         self.ticks = {}                                         # mutable
         self.open = None                                        # mutable
         self.won = False                                        # mutable
         self.n_load = 20                                        # mutable
-        self.ewm_dv = {'mean': 0, 'var': 1}                     # mutable
-        self.bollinger = []                                     # mutable
+        self.ewm_dv = (0, 1)                                    # mutable
+        self.bollinger_band = ()                                # mutable
         self.order_side = None                                  # mutable
         self.init_margin = None                                 # mutable
         self.margin = None                                      # mutable
         self.position = {}                                      # mutable
         self.sfd_penal_side = None                              # mutable
-        self.volumes = pd.DataFrame()                           # mutable
+        self.volumes = {'BUY': 0, 'SELL': 0}                    # mutable
         self.reserved = {}                                      # mutable
-        self.order_datetime = None                              # mutable
+        self.order_time = None                                  # mutable
         self.last_open = {}                                     # mutable
         self.retried_side = None                                # mutable
         self.anchor_margin = 0                                  # mutable
         self.n_size_over = 0                                    # mutable
-        self.logger.debug(vars(self))
+        self.api_cache = {}                                     # mutable
+        self.logger.debug({k: getattr(self, k) for k in self.__slots__})
 
     def message(self, pubnub, message):
         if message.channel.startswith('lightning_executions_FX_'):
-            self.volumes = pd.DataFrame(
-                message.message
-            )[['side', 'size']].append(
-                pd.DataFrame({'side': ['BUY', 'SELL'], 'size': [0, 0]})
-            ).groupby('side')['size'].sum()
+            self.volumes = self._sum_sizes_by_side(records=message.message)
             self.ewm_dv = self._calculate_ewm_delta_volume()
             self.bollinger_band = self._calculate_bollinger_bands()
+            if self.n_load <= 0:
+                self.order_side = self._determine_order_side()
+            position_future = (
+                self.executor.submit(self._fetch_position)
+                if self.n_load == 1 or (self.n_load <= 0 and self.order_side)
+                else None
+            )
             try:
                 self.margin = self._fetch_margin()
             except Exception as e:
                 self.logger.error(e)
             else:
                 if self.n_load <= 0:
-                    self.order_side = self._determine_order_side()
                     if self.order_side:
                         try:
-                            self.position = self._fetch_position()
+                            self.position = position_future.result()
                             self.sfd_penal_side = self._fetch_sfd_penal_side()
                         except Exception as e:
                             self.logger.error(e)
@@ -76,20 +114,17 @@ class BfStreamTrader(SubscribeCallback):
                     else:
                         self._print(
                             'Skip by delta volume.{}'.format(
-                                ' (bb: {})'.format(
-                                    np.array2string(
-                                        self.bollinger_band,
-                                        formatter={
-                                            'float_kind':
-                                            lambda f: '{:5.1f}'.format(f)
-                                        }
-                                    )
-                                ) if self.trade.get('bollinger') else ''
+                                ' (bb: [{}])'.format(
+                                    ' '.join([
+                                        '{:5.1f}'.format(f)
+                                        for f in self.bollinger_band
+                                    ])
+                                ) if self.bollinger else ''
                             )
                         )
                 elif self.n_load == 1:
                     try:
-                        self.reserved = self._fetch_position()
+                        self.reserved = position_future.result()
                     except Exception as e:
                         self.logger.error(e)
                     else:
@@ -111,13 +146,23 @@ class BfStreamTrader(SubscribeCallback):
             self.ticks[message.channel] = message.message
             self.logger.debug(self.ticks)
         else:
-            self.logger.error('message.channel: {}'.format(message.channel))
+            self.logger.error('message.channel: %s', message.channel)
 
     @staticmethod
-    def _reverse_side(side):
-        return side and {'BUY': 'SELL', 'SELL': 'BUY'}[side]
+    def _sum_sizes_by_side(records):
+        sizes = {'SELL': 0, 'BUY': 0}
+        for r in records:
+            if r['side'] in sizes:
+                sizes[r['side']] += r['size']
+        return sizes
+
+    @classmethod
+    def _reverse_side(cls, side):
+        return side and cls.reversed_sides[side]
 
     def _print(self, message):
+        if self.quiet and not self.logger.isEnabledFor(logging.INFO):
+            return
         text = (
             '| BUY:{0} | SELL:{1} | EWM DELTA:{2:8.3f} | MARGIN:  {3} |' +
             ' PL:{4:' + str(len(str(int(self.margin))) + 1) + 'd} |\t> {5}'
@@ -126,9 +171,9 @@ class BfStreamTrader(SubscribeCallback):
                 (
                     '{:8.3f}'.format(self.volumes[s]) if self.volumes[s]
                     else ' ' * 8
-                ) for s in ['BUY', 'SELL']
+                ) for s in ('BUY', 'SELL')
             ],
-            self.ewm_dv['mean'], round(self.margin),
+            self.ewm_dv[0], round(self.margin),
             round(self.margin - self.init_margin),
             message
         )
@@ -142,7 +187,7 @@ class BfStreamTrader(SubscribeCallback):
             order_side = self._reverse_side(self.reserved['side'])
         elif self.retry and self.retried_side:
             order_side = self.retried_side
-        elif self.bollinger_band.size > 2:
+        elif len(self.bollinger_band) > 2:
             if self.bollinger_band[0] < 0 and self.bollinger_band[1] > 0:
                 order_side = ('SELL' if self.contrary else 'BUY')
             elif self.bollinger_band[- 1] > 0 and self.bollinger_band[- 2] < 0:
@@ -156,34 +201,45 @@ class BfStreamTrader(SubscribeCallback):
                 order_side = ('BUY' if self.contrary else 'SELL')
             else:
                 order_side = self._reverse_side(self.reserved.get('side'))
-        self.logger.info('order_side: {}'.format(order_side))
+        self.logger.info('order_side: %s', order_side)
         return order_side
 
+    def _call_api(self, method, **kwargs):
+        key = (method.__name__, tuple(sorted(kwargs.items())))
+        cached = self.api_cache.get(key)
+        if cached and time.monotonic() - cached[0] < self.api_ttl:
+            res = cached[1]
+        else:
+            res = method(**kwargs)
+            if isinstance(res, (dict, list)) and 'status' not in res:
+                self.api_cache[key] = (time.monotonic(), res)
+        return res
+
     def _fetch_margin(self):
-        collateral = self.bF.getcollateral()
+        collateral = self._call_api(self.getcollateral)
         if isinstance(collateral, dict) and 'status' not in collateral:
             self.logger.debug(collateral)
             margin = collateral['collateral'] + collateral['open_position_pnl']
-            self.logger.info('margin: {}'.format(margin))
+            self.logger.info('margin: %s', margin)
         else:
             raise BfautError(collateral)
         return margin
 
     def _fetch_position(self):
-        positions = self.bF.getpositions(product_code=('FX_' + self.pair))
+        positions = self._call_api(
+            self.getpositions, product_code=self.fx_pair
+        )
         if isinstance(positions, list) and 'status' not in positions:
-            self.logger.info('positions: {}'.format(positions))
-            ps_sizes = {
-                s: sum([p['size'] for p in positions if p['side'] == s])
-                for s in ['SELL', 'BUY']
-            }
-            ps_size = max(ps_sizes.values())
-            ps_side = (
-                [k for k, v in ps_sizes.items() if v == ps_size][0]
-                if ps_size > 0 else None
-            )
+            self.logger.info('positions: %s', positions)
+            ps_sizes = self._sum_sizes_by_side(records=positions)
+            if ps_sizes['SELL'] >= ps_sizes['BUY']:
+                ps_side, ps_size = 'SELL', ps_sizes['SELL']
+            else:
+                ps_side, ps_size = 'BUY', ps_sizes['BUY']
+            if ps_size <= 0:
+                ps_side = None
             position = {'side': ps_side, 'size': round(ps_size * 1000) / 1000}
-            self.logger.info('position: {}'.format(position))
+            self.logger.info('position: %s', position)
         else:
             raise BfautError(positions)
         return position
@@ -193,50 +249,35 @@ class BfStreamTrader(SubscribeCallback):
             k.replace('lightning_ticker_', ''): v['ltp']
             for k, v in self.ticks.items()
         }
-        self.logger.info('mp: {}'.format(mp))
-        deviation = (mp['FX_' + self.pair] - mp[self.pair]) / mp[self.pair]
-        self.logger.info('deviation: {}'.format(deviation))
+        self.logger.info('mp: %s', mp)
+        deviation = (mp[self.fx_pair] - mp[self.pair]) / mp[self.pair]
+        self.logger.info('deviation: %s', deviation)
         sfd_penal_side = (
             ('BUY' if deviation >= 0 else 'SELL')
             if abs(deviation) >= self.sfd_pins.min() else None
         )
-        self.logger.info('sfd_penal_side: {}'.format(sfd_penal_side))
+        self.logger.info('sfd_penal_side: %s', sfd_penal_side)
         return sfd_penal_side
 
     def _calculate_ewm_delta_volume(self):
         delta_volume = self.volumes['BUY'] - self.volumes['SELL']
-        self.logger.info('delta_volume: {}'.format(delta_volume))
-        ewm_dv = {
-            'mean': (
-                self.trade['ewm_alpha'] * delta_volume +
-                (1 - self.trade['ewm_alpha']) * self.ewm_dv['mean']
-            ),
-            'var': (
-                (1 - self.trade['ewm_alpha']) * (
-                    self.ewm_dv['var'] + self.trade['ewm_alpha'] *
-                    np.square(delta_volume - self.ewm_dv['mean'])
-                )
-            )
-        }
-        self.logger.info('ewm_dv: {}'.format(ewm_dv))
+        self.logger.info('delta_volume: %s', delta_volume)
+        mean, var = self.ewm_dv
+        ewm_dv = update_ewm(
+            alpha=self.ewm_alpha, x=delta_volume, mean=mean, var=var
+        )
+        self.logger.info('ewm_dv: (mean, var) = %s', ewm_dv)
         return ewm_dv
 
     def _calculate_bollinger_bands(self):
-        b = (self.trade.get('bollinger') or [0])
-        multipliers = (b if b and isinstance(b, list) else [b])
-        return np.sort(np.concatenate([
-            self.ewm_dv['mean'] + np.array([- m, m]) *
-            np.sqrt(self.ewm_dv['var'])
-            for m in multipliers
-        ]))
+        mean, var = self.ewm_dv
+        sd = math.sqrt(var)
+        return tuple(mean + s * sd for s in self.bollinger_sigmas)
 
     def _calculate_order_size(self):
         if self.open:
-            init_size = (
-                self.trade['size'].get('init') or
-                self.trade['size'].get('unit') or 0.001
-            )
-            self.logger.info('init_size: {}'.format(init_size))
+            init_size = self.init_size
+            self.logger.info('init_size: %s', init_size)
             if self.last_open and self.n_size_over == 1:
                 bet_size = self.last_open['size']
             elif self.last_open and self.n_size_over == 0:
@@ -250,23 +291,23 @@ class BfStreamTrader(SubscribeCallback):
                         bet_size = init_size
                     else:
                         bet_size = (
-                            self.last_open['size'] + self.trade['size']['unit']
+                            self.last_open['size'] + self.unit_size
                         )
                 elif self.betting_system == 'Pyramid':
                     if self.won:
                         bet_size = (
-                            self.last_open['size'] - self.trade['size']['unit']
+                            self.last_open['size'] - self.unit_size
                         )
                     else:
                         bet_size = (
-                            self.last_open['size'] + self.trade['size']['unit']
+                            self.last_open['size'] + self.unit_size
                         )
                 elif self.betting_system == "Oscar's grind":
                     if self.margin >= self.anchor_margin:
                         bet_size = init_size
                     elif self.won:
                         bet_size = (
-                            self.last_open['size'] + self.trade['size']['unit']
+                            self.last_open['size'] + self.unit_size
                         )
                     else:
                         bet_size = self.last_open['size']
@@ -274,10 +315,9 @@ class BfStreamTrader(SubscribeCallback):
                     bet_size = init_size
             else:
                 bet_size = init_size
-            self.logger.info('bet_size: {}'.format(bet_size))
+            self.logger.info('bet_size: %s', bet_size)
             size_range = sorted([
-                (self.trade['size'].get('min') or bet_size),
-                (self.trade['size'].get('max') or bet_size)
+                (self.min_size or bet_size), (self.max_size or bet_size)
             ])
             if bet_size < size_range[0]:
                 order_size = size_range[0]
@@ -287,7 +327,7 @@ class BfStreamTrader(SubscribeCallback):
                 order_size = round(bet_size * 1000) / 1000
         else:
             order_size = self.reserved['size']
-        self.logger.info('order_size: {}'.format(order_size))
+        self.logger.info('order_size: %s', order_size)
         return order_size
 
     def _trade(self):
@@ -296,31 +336,29 @@ class BfStreamTrader(SubscribeCallback):
             if self.reserved else False
         )
         if (
-                self.order_datetime and queue_is_left and
-                datetime.now() - self.order_datetime < self.timeout_delta
+                self.order_time is not None and queue_is_left and
+                time.monotonic() - self.order_time < self.timeout_sec
         ):
             self.logger.info('Wait for execution.')
         else:
             self.logger.info('Calibrate reserved size.')
             self.reserved = self.position
-            self.order_datetime = None
-        self.logger.info('self.reserved: {}'.format(self.reserved))
+            self.order_time = None
+        self.logger.info('self.reserved: %s', self.reserved)
         if self.last_open and not queue_is_left:
             self.won = (self.margin > self.last_open['margin'])
         else:
             pass
-        self.logger.info('self.won: {}'.format(self.won))
+        self.logger.info('self.won: %s', self.won)
         if self.betting_system == "Oscar's grind" and self.anchor_margin:
             anchor_pl = self.margin - self.anchor_margin
-            self.logger.info('pl in round: {}'.format(anchor_pl))
+            self.logger.info('pl in round: %s', anchor_pl)
             no_position = (self.reserved['size'] == 0 and not queue_is_left)
             if anchor_pl >= 0 and no_position:
                 self.anchor_margin = 0
             else:
                 pass
-            self.logger.info(
-                'self.anchor_margin: {}'.format(self.anchor_margin)
-            )
+            self.logger.info('self.anchor_margin: %s', self.anchor_margin)
         else:
             pass
         self.open = (self.reserved['size'] < 0.001)
@@ -343,9 +381,10 @@ class BfStreamTrader(SubscribeCallback):
                 'Skip by sfd penalty. (side: {})'.format(self.sfd_penal_side)
             )
         else:
+            self.api_cache = {}
             try:
-                order = self.bF.sendchildorder(
-                    product_code=('FX_' + self.pair),
+                order = self.sendchildorder(
+                    product_code=self.fx_pair,
                     child_order_type='MARKET',
                     side=self.order_side,
                     size=order_size,
@@ -363,12 +402,12 @@ class BfStreamTrader(SubscribeCallback):
                 self._print(
                     '{0} {1} {2}. => {3}.'.format(
                         self.order_side, order_size,
-                        self.pair.replace('_', '-FX/'),
+                        self.display_pair,
                         'Accepted' if order_is_accepted else 'Rejected'
                     )
                 )
                 if order_is_accepted:
-                    self.order_datetime = datetime.now()
+                    self.order_time = time.monotonic()
                     if self.open:
                         self.last_open = {
                             'side': self.order_side, 'size': order_size,
@@ -384,9 +423,8 @@ class BfStreamTrader(SubscribeCallback):
                             else:
                                 self.anchor_margin = self.margin
                                 self.logger.info(
-                                    'self.anchor_margin: {}'.format(
-                                        self.anchor_margin
-                                    )
+                                    'self.anchor_margin: %s',
+                                    self.anchor_margin
                                 )
                         else:
                             pass
@@ -417,7 +455,17 @@ class BfStreamTrader(SubscribeCallback):
                     pprint(order)
 
 
+def update_ewm(alpha, x, mean, var):
+    delta = x - mean
+    return (
+        mean + alpha * delta,
+        (1 - alpha) * (var + alpha * delta * delta)
+    )
+
+
 def open_deal(config, pair, timeout=3600, quiet=False):
+    use_uvloop()
+    use_orjson()
     bas = BfAsyncSubscriber(
         channels=[
             'lightning_executions_FX_{}'.format(pair),
@@ -425,13 +473,12 @@ def open_deal(config, pair, timeout=3600, quiet=False):
             'lightning_ticker_{}'.format(pair)
         ]
     )
-    bas.pubnub.add_listener(
-        BfStreamTrader(
-            config=config, pair=pair, timeout=timeout, quiet=quiet
-        )
+    bst = BfStreamTrader(
+        config=config, pair=pair, timeout=timeout, quiet=quiet
     )
+    bas.pubnub.add_listener(bst)
     bas.subscribe()
-    signal.signal(signal.SIGINT, signal.SIG_DFL)
     if not quiet:
         print('!!! OPEN DEAL !!!')
-    bas.pubnub.start()
+    bas.start()
+    bst.executor.shutdown()
@@ -14,12 +14,15 @@ setup(
     install_requires=[
         'docopt',
         'numpy',
-        'pandas',
         'pubnub',
         'pyyaml',
         'pybitflyer',
-        'tornado'
+        'tornado>=5,<6'
     ],
+    extras_require={
+        'orjson': ['orjson'],
+        'uvloop': ['uvloop']
+    },
     entry_points={
         'console_scripts': ['bfaut=bfaut.cli:main'],
     }